@@ -3,146 +3,347 @@ Routines for decoding, inspecting, manipulating, and re-encoding Factorio
 blueprints.
 """
 
-import base64
-import collections
+import binascii
 import json
-import zlib
+import os
+import string
+from collections import Counter
+from collections.abc import MutableSequence
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from operator import itemgetter
+from pathlib import Path
+
+try:
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# default zlib level used when encoding exchange strings, read at call time
+# so it can be overridden module-wide; level 9 is several times slower than
+# 6 for a negligible size win on blueprint json
+COMPRESSION_LEVEL = 6
+
+# number of exchange string characters decoded per step
+DECODE_CHUNK_SIZE = 1 << 16
+
+# bytes binascii.a2b_base64 skips; they must be removed before chunking
+# so that 4-character groups stay aligned
+_BASE64_ALPHABET = (string.ascii_letters + string.digits + "+/=").encode()
+_NON_BASE64 = bytes(set(range(256)).difference(_BASE64_ALPHABET))
+
+
+def _json_loads(json_str):
+    """Parse json text (str or utf8 bytes), preferring orjson when present"""
+    if orjson is not None:
+        return orjson.loads(json_str)
+    return json.loads(json_str)
+
+
+def _json_dumps(data, **kwargs):
+    """Serialize data to compact utf8 json bytes, preferring orjson.
+
+    orjson is only used for the default compact output. It produces
+    equivalent json, not identical bytes: floats may be spelled
+    differently (1e-7 vs 1e-07) and NaN/Infinity become null. Data orjson
+    rejects (non-str dict keys, ints beyond 64 bits) and any json.dumps
+    keyword arguments (indent etc.) go through the stdlib encoder.
+    """
+    if orjson is not None and not kwargs:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # orjson.JSONEncodeError subclasses TypeError
+            pass
+    return json.dumps(
+        data,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        **kwargs
+    ).encode("utf8")
+
+
+def _decode_exchange_string(exchange_str):
+    """base64-decode and inflate an exchange string (after its version byte)
+    to json bytes.
+
+    The payload is decoded a chunk at a time and fed straight to the
+    decompressor, so the full compressed blob is never held in memory.
+    """
+    decompressor = zlib.decompressobj()
+    pieces = []
+    pending = b""
+    for start in range(1, len(exchange_str), DECODE_CHUNK_SIZE):
+        # drop non-base64 characters (e.g. line wrapping) and carry any
+        # partial 4-character group over to the next chunk
+        chunk = exchange_str[start:start + DECODE_CHUNK_SIZE].encode("ascii")
+        chunk = pending + chunk.translate(None, _NON_BASE64)
+        aligned = len(chunk) - len(chunk) % 4
+        pending = chunk[aligned:]
+        chunk = binascii.a2b_base64(chunk[:aligned])
+        pieces.append(decompressor.decompress(chunk))
+    if pending:
+        # a dangling partial group is malformed; let binascii report it
+        binascii.a2b_base64(pending)
+    pieces.append(decompressor.flush())
+    if not decompressor.eof:
+        raise zlib.error("Incomplete or truncated exchange string")
+    return b"".join(pieces)
+
+
+def _entity_lists(entries):
+    """Yield the entity list of each blueprint in a book's raw entry dicts,
+    descending into nested books; other entries are skipped."""
+    for entry in entries:
+        if "blueprint_book" in entry:
+            yield from _entity_lists(
+                entry["blueprint_book"].get("blueprints", ()))
+        elif "blueprint" in entry:
+            yield entry["blueprint"].get("entities", ())
 
 
 class EncodedBlob(object):
     """one Factorio json->gzip->base64 encoded blob"""
 
+    __slots__ = ("_data", "version_byte", "_data_type", "_inner_data", "_owner")
+
     def __init__(self, data=None, version_byte=None):
+        # list holding self.data when this wraps one of a book's blueprints
+        self._owner = None
         self.data = data or {}
         self.version_byte = version_byte
 
     def __getattr__(self, attr):
         """Generically provide access to blueprint.data.blueprint.entities etc"""
-        return self.inner_data.get(attr)
+        return self._inner_data.get(attr)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # NOTE: data_type, inner_data and generic attribute access only
+        # follow a new root when it is assigned here; replacing the root key
+        # in place (blob.data["blueprint"] = {...}) leaves them reading the
+        # old dict, so assign the whole mapping via blob.data = {...} instead
+        if self._owner is not None:
+            # write the new dict back into the book in place of the old one
+            for i, item in enumerate(self._owner):
+                if item is self._data:
+                    self._owner[i] = data
+                    break
+            else:
+                self._owner = None
+        self._data = data
+        # the root key and its dict are looked up on every generic attribute
+        # access, so resolve them once here rather than on each read
+        self._data_type = next(iter(data), None)
+        self._inner_data = data.get(self._data_type)
 
     @property
     def data_type(self):
-        data_type, _ = next(iter(self.data.items()))
-        return data_type
+        return self._data_type
 
     @property
     def inner_data(self):
-        _, inner_data = next(iter(self.data.items()))
-        return inner_data
+        return self._inner_data
 
     @classmethod
     def from_exchange_string(cls, exchange_str):
         version_byte = exchange_str[0]
-        decoded = base64.b64decode(exchange_str[1:])
-        json_str = zlib.decompress(decoded)
-        data = json.loads(json_str, object_pairs_hook=collections.OrderedDict)
+        data = _json_loads(_decode_exchange_string(exchange_str))
         return cls(data = data, version_byte = version_byte)
 
     @classmethod
     def from_exchange_file(cls, filename):
-        return cls.from_exchange_string(open(filename).read().strip())
+        return cls.from_exchange_string(
+            Path(filename).read_text(encoding="ascii").strip())
 
     @classmethod
     def from_json_string(cls, json_str):
-        data = json.loads(json_str, object_pairs_hook=collections.OrderedDict)
+        data = _json_loads(json_str)
         version_byte = data.pop("version_byte", None)
         return cls(data = data, version_byte = version_byte)
 
     @classmethod
     def from_json_file(cls, filename):
-        return cls.from_json_string(open(filename).read().strip())
+        return cls.from_json_string(Path(filename).read_bytes())
 
-    def to_exchange_string(self, **kwargs):
+    def to_exchange_string(self, level=None, **kwargs):
+        """Encode as an exchange string, compressed at the given zlib level
+        (COMPRESSION_LEVEL if not given)"""
         if self.version_byte is None:
             raise RuntimeError(
 		"Attempted to convert to exchange string with no version_byte")
+        if level is None:
+            level = COMPRESSION_LEVEL
         json_str = self.to_json_string(**kwargs)
-        compressed = zlib.compress(json_str, 9)
-        encoded = base64.b64encode(compressed)
+        compressed = zlib.compress(json_str, level)
+        encoded = binascii.b2a_base64(compressed, newline=False)
         return self.version_byte + encoded.decode()
 
-    def to_exchange_file(self, filename):
-        open(filename, "w").write(self.to_exchange_string())
+    def to_exchange_file(self, filename, **kwargs):
+        Path(filename).write_text(
+            self.to_exchange_string(**kwargs), encoding="ascii")
 
     def to_json_string(self, **kwargs):
-        data = self.data.copy()
+        data = self.data
         if self.version_byte is not None:
-            data["version_byte"] = self.version_byte
-        json_str = json.dumps(
-            data,
-            separators=(",", ":"),
-            ensure_ascii=False,
-            **kwargs
-        ).encode("utf8")
-        return json_str
+            data = {**data, "version_byte": self.version_byte}
+        return _json_dumps(data, **kwargs)
 
     def to_json_file(self, filename, **kwargs):
-        open(filename, "w").write(self.to_json_string(**kwargs))
+        Path(filename).write_bytes(self.to_json_string(**kwargs))
 
 class Blueprint(EncodedBlob):
     """one Factorio blueprint"""
 
+    __slots__ = ()
+
     def remove_entity_numbers(self):
         """Remove blueprint.data["blueprint"]["entities"][*]["entity_number"]"""
-        next_number = 1
-        for entity in self.entities:
+        for next_number, entity in enumerate(self.entities, 1):
             number = entity.pop("entity_number", None)
             # replace_entity_numbers assumes sequential numbers starting at 1
             # this assert will trigger bug reports if that assumption is wrong
             assert number == next_number or number == None
-            next_number = next_number + 1
 
     def replace_entity_numbers(self):
-        number = 1
-        for entity in self.entities:
+        for number, entity in enumerate(self.entities, 1):
             entity["entity_number"] = number
-            number = number + 1
 
     def materials(self):
         """Totals of each entity contained in the blueprint."""
-        mats = {}
-        for ent in self.entities:
-            name = ent["name"]
-            mats[name] = mats.setdefault(name, 0) + 1
-        return mats
+        return Counter(map(itemgetter("name"), self.entities))
 
 
 class BlueprintBook(EncodedBlob):
     """one Factorio blueprint book, containing zero or more blueprints"""
 
-    def __init__(self, *args, **kwargs):
-        super(BlueprintBook, self).__init__(*args, **kwargs)
-        self.objectify_blueprints()
-
-    def objectify_blueprints(self):
-        # convert internal blueprint dicts to Blueprint objects
-        self.data["blueprint_book"]["blueprints"] = list(map(
-            lambda data: Blueprint(data=data, version_byte=self.version_byte),
-            self.data["blueprint_book"]["blueprints"]
-        ))
+    __slots__ = ()
 
-    def to_json_string(self, **kwargs):
-        # convert internal Blueprint objects back to dicts for serialization
-        self.data["blueprint_book"]["blueprints"] = list(map(
-            lambda blueprint: blueprint.data,
-            self.data["blueprint_book"]["blueprints"]
-        ))
-        json_str = super(BlueprintBook, self).to_json_string(**kwargs)
-        self.objectify_blueprints()
-        return json_str
+    @property
+    def blueprints(self):
+        """The contained blueprints, wrapped as Blueprint objects on access"""
+        return _BlueprintList(self)
 
     def remove_indexes(self):
         """Remove self.data["blueprint_book"]["blueprints"][*]["index"]"""
-        next_number = 0
-        for blueprint in self.blueprints:
+        for next_number, blueprint in enumerate(self.blueprints):
             number = blueprint.data.pop("index", None)
             # replace_indexes assumes sequential numbers starting at 0
             # this assert will trigger bug reports if that assumption is wrong
             assert number == next_number or number == None
-            next_number = next_number + 1
 
     def replace_indexes(self):
-        number = 0
-        for blueprint in self.blueprints:
+        for number, blueprint in enumerate(self.blueprints):
             blueprint.data["index"] = number
-            number = number + 1
+
+    def to_exchange_strings(self, max_workers=None, **kwargs):
+        """Encode each contained blueprint as its own exchange string.
+
+        Blueprints are independent, so they are encoded on a thread pool;
+        zlib releases the GIL while compressing. Keyword arguments are
+        passed to Blueprint.to_exchange_string.
+        """
+        blueprints = list(self.blueprints)
+        if len(blueprints) < 2:
+            return [blueprint.to_exchange_string(**kwargs)
+                    for blueprint in blueprints]
+        with ThreadPoolExecutor(max_workers or os.cpu_count()) as executor:
+            return list(executor.map(
+                lambda blueprint: blueprint.to_exchange_string(**kwargs),
+                blueprints
+            ))
+
+    def materials(self):
+        """Totals of each entity contained in all of the book's blueprints,
+        including those in nested books."""
+        return Counter(map(itemgetter("name"), chain.from_iterable(
+            _entity_lists(self.inner_data.get("blueprints", ()))
+        )))
+
+
+class _BlueprintList(MutableSequence):
+    """List-like view of a book's blueprint dicts as Blueprint objects.
+
+    The book keeps the raw dicts, so serializing it needs no conversion;
+    each Blueprint is a thin wrapper built when it is read and shares its
+    data dict with the book. Assigning a wrapper's data replaces the dict
+    in the book. Blueprints (or raw dicts) stored into the view are kept
+    as their data dicts, and lookups (in, index, count, remove) match a
+    Blueprint by the identity of its data dict.
+    """
+
+    __slots__ = ("_book",)
+
+    def __init__(self, book):
+        self._book = book
+
+    def _wrap(self, data):
+        blueprint = Blueprint(data=data, version_byte=self._book.version_byte)
+        blueprint._owner = self._book.inner_data["blueprints"]
+        return blueprint
+
+    @staticmethod
+    def _unwrap(blueprint):
+        if isinstance(blueprint, EncodedBlob):
+            return blueprint.data
+        return blueprint
+
+    def __len__(self):
+        return len(self._book.inner_data["blueprints"])
+
+    def __getitem__(self, index):
+        blueprints = self._book.inner_data["blueprints"]
+        if isinstance(index, slice):
+            return [self._wrap(data) for data in blueprints[index]]
+        return self._wrap(blueprints[index])
+
+    def __iter__(self):
+        return map(self._wrap, self._book.inner_data["blueprints"])
+
+    def __setitem__(self, index, value):
+        blueprints = self._book.inner_data["blueprints"]
+        if isinstance(index, slice):
+            blueprints[index] = [self._unwrap(item) for item in value]
+        else:
+            blueprints[index] = self._unwrap(value)
+
+    def __delitem__(self, index):
+        del self._book.inner_data["blueprints"][index]
+
+    def insert(self, index, value):
+        self._book.inner_data["blueprints"].insert(index, self._unwrap(value))
+
+    def __contains__(self, value):
+        data = self._unwrap(value)
+        return any(item is data for item in self._book.inner_data["blueprints"])
+
+    def index(self, value, start=0, stop=None):
+        data = self._unwrap(value)
+        blueprints = self._book.inner_data["blueprints"]
+        for i in range(*slice(start, stop).indices(len(blueprints))):
+            if blueprints[i] is data:
+                return i
+        raise ValueError("blueprint is not in the book")
+
+    def count(self, value):
+        data = self._unwrap(value)
+        return sum(item is data for item in self._book.inner_data["blueprints"])
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def sort(self, key=None, reverse=False):
+        """Sort the book's blueprints in place; key is given Blueprints"""
+        self._book.inner_data["blueprints"].sort(
+            key=None if key is None else lambda data: key(self._wrap(data)),
+            reverse=reverse
+        )